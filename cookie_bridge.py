@@ -6,22 +6,38 @@ Gemini Cookie 上传器 (Supabase REST API 版)
 直接接收浏览器扩展的 POST 请求，并将数据写入 Supabase 数据库。
 浏览器扩展指向本服务地址：http://127.0.0.1:8002/api/cookies
 
+/api/cookies 立即返回 202 Accepted，Supabase 写入由后台微批队列异步完成，
+扩展侧只感知本地往返延迟。
+
 前置条件：
-pip install fastapi uvicorn requests
+pip install fastapi uvicorn httpx
 """
 
 import os
-import requests
+import sys
+import asyncio
+import hashlib
+import httpx
 from datetime import datetime
 from typing import Optional
 
 try:
-    from fastapi import FastAPI, HTTPException
+    # C 实现的 logging 替代品，单条日志开销约为标准库的 1/4
+    import picologging as logging
+except ImportError:
+    import logging
+
+try:
+    from fastapi import FastAPI, HTTPException, Request, Response
     from fastapi.middleware.cors import CORSMiddleware
-    from pydantic import BaseModel
+    from fastapi.middleware.gzip import GZipMiddleware
+    from fastapi.responses import ORJSONResponse, StreamingResponse
+    import orjson
+    from pydantic import AliasChoices, BaseModel, ConfigDict, Field
+    from cachetools import TTLCache
     import uvicorn
 except ImportError:
-    print("请先安装依赖: pip install fastapi uvicorn requests")
+    print("请先安装依赖: pip install fastapi uvicorn httpx cachetools")
     exit(1)
 
 # ================= 配置区域 =================
@@ -34,7 +50,14 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "https://your-project.supabase.co")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "your-anon-key")
 # ===========================================
 
-app = FastAPI(title="Gemini Cookie Uploader (Supabase REST)")
+# orjson (Rust 实现) 序列化大数组比标准库 json 快一个数量级
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger("cookie_bridge")
+
+app = FastAPI(
+    title="Gemini Cookie Uploader (Supabase REST)",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,6 +67,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 账号列表里的 headers 字段重复度高、极易压缩，gzip 可省 5-10 倍传输量
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # 构造 Base URL 和 Headers
 API_URL = f"{SUPABASE_URL.rstrip('/')}/rest/v1" if SUPABASE_URL else ""
 HEADERS = {
@@ -53,9 +79,152 @@ HEADERS = {
     "Prefer": "return=representation"
 }
 
+class CookiePayload(BaseModel):
+    """浏览器扩展上传的 Cookie 数据（验证交给 pydantic-core，缺字段自动 422）"""
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    alias: str
+    psid: str = Field(validation_alias=AliasChoices("__Secure-1PSID", "secure_1psid", "psid"))
+    psidts: str = Field(validation_alias=AliasChoices("__Secure-1PSIDTS", "secure_1psidts", "psidts"))
+    proxy: Optional[str] = None
+    headers: Optional[dict] = None
+
+
+# "下一个账号" 热路径的内存快照：取号只做一次就地轮询自增，
+# 不等 Supabase；后台每 30s 刷新一次，写入后立即刷新
+_SNAPSHOT_REFRESH_INTERVAL = 30
+
+
+async def _refresh_snapshot():
+    # 快照要带 headers：/api/accounts/next 的消费方（示例 03 的
+    # get_account_with_headers 等）正是为了拿浏览器请求头；
+    # 快照 30s 才刷新一次，多这一列的传输代价可以忽略
+    resp = await app.state.client.get(
+        "/gemini_accounts",
+        params={
+            "enabled": "eq.true",
+            "order": "call_count.asc",
+            "select": _SNAPSHOT_COLUMNS,
+        }
+    )
+    if resp.status_code == 200:
+        app.state.accounts_snapshot = resp.json()
+
+
+async def _snapshot_refresher():
+    while True:
+        if is_configured():
+            try:
+                await _refresh_snapshot()
+            except Exception as e:
+                logger.error("Snapshot refresh error: %s", e)
+        await asyncio.sleep(_SNAPSHOT_REFRESH_INTERVAL)
+
+
+# 账号列表短 TTL 缓存：列表随 Cookie 刷新节奏变化（分钟级），批量示例的
+# 重复查询无需每次都打到 Supabase
+_ACCOUNTS_CACHE = TTLCache(maxsize=8, ttl=15)
+
+# Upsert 微批队列：突发上传攒批后一次性数组 POST，整批在 PostgREST
+# 单事务内完成，摊薄每行的 HTTP + 事务开销
+_UPSERT_QUEUE: asyncio.Queue = asyncio.Queue()
+_FLUSH_INTERVAL = 0.1   # 秒
+_FLUSH_MAX_ROWS = 50
+
+# 批量 upsert 的附加请求头在导入时构造一次，省掉每次冲刷的 dict 构造
+_UPSERT_PREFER = {"Prefer": "resolution=merge-duplicates"}
+
+
+async def _flush_rows(rows):
+    """把攒下的行按 alias 去重（保留最新）后批量 upsert 到 Supabase"""
+    deduped = {row["alias"]: row for row in rows}
+
+    # PostgREST 要求数组里所有对象的键完全一致（否则 PGRST102 整批拒绝），
+    # 而 proxy/headers 只在扩展带了才会出现——按键集合分组，
+    # 每组各发一次数组 POST，混合负载不会拖垮整批
+    groups: dict = {}
+    for row in deduped.values():
+        groups.setdefault(frozenset(row), []).append(row)
+
+    for batch in groups.values():
+        resp = await app.state.client.post(
+            "/gemini_accounts",
+            params={"on_conflict": "alias"},
+            headers=_UPSERT_PREFER,
+            json=batch
+        )
+        if resp.status_code not in (200, 201, 204):
+            raise Exception(f"Batch upsert failed: {resp.text}")
+
+    _ACCOUNTS_CACHE.clear()
+    # 账号数据已变，立即刷新取号快照，不等下一个 30s 周期
+    await _refresh_snapshot()
+
+
+async def _flusher():
+    """后台循环：每 100ms 或攒满 50 行冲刷一次"""
+    while True:
+        await asyncio.sleep(_FLUSH_INTERVAL)
+        rows = []
+        while not _UPSERT_QUEUE.empty() and len(rows) < _FLUSH_MAX_ROWS:
+            rows.append(_UPSERT_QUEUE.get_nowait())
+        if rows:
+            try:
+                await _flush_rows(rows)
+            except Exception as e:
+                logger.error("Batch upsert error: %s", e)
+
+
 def is_configured():
     return SUPABASE_URL and SUPABASE_KEY and "your-project" not in SUPABASE_URL
 
+
+@app.on_event("startup")
+async def startup_client():
+    # 全局共享的异步客户端：复用连接池，Supabase 往返期间事件循环可以继续处理其他请求
+    # 池大小按预期并发（扩展客户端数 × 账号数）设置，避免默认池在
+    # 高峰期成为瓶颈；keepalive_expiry 略小于 PostgREST 的空闲超时
+    app.state.client = httpx.AsyncClient(
+        base_url=API_URL,
+        headers=HEADERS,
+        http2=True,
+        timeout=httpx.Timeout(connect=2.0, read=8.0, write=8.0, pool=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=30,
+            max_connections=100,
+            keepalive_expiry=30.0,
+        ),
+    )
+    app.state.flusher = asyncio.create_task(_flusher())
+    app.state.accounts_snapshot = []
+    app.state.rr_idx = 0
+    app.state.snapshot_refresher = asyncio.create_task(_snapshot_refresher())
+
+    # 预热：启动时先和 PostgREST 握一次手，把 keep-alive 连接放进池里，
+    # 首个真实请求就不用付 TCP+TLS 协商的冷启动成本
+    if is_configured():
+        try:
+            await app.state.client.head("/gemini_accounts", params={"limit": "1"})
+        except httpx.HTTPError:
+            pass
+
+
+@app.on_event("shutdown")
+async def shutdown_client():
+    # 先停冲刷循环，把队列里剩余的行写完再关闭连接
+    app.state.snapshot_refresher.cancel()
+    app.state.flusher.cancel()
+    remaining = []
+    while not _UPSERT_QUEUE.empty():
+        remaining.append(_UPSERT_QUEUE.get_nowait())
+    if remaining:
+        try:
+            await _flush_rows(remaining)
+        except Exception as e:
+            logger.error("Final flush error: %s", e)
+    await app.state.client.aclose()
+
 @app.get("/")
 async def root():
     return {
@@ -65,133 +234,217 @@ async def root():
         "usage": "Set Chrome Extension URL to http://127.0.0.1:8002/api/cookies"
     }
 
+@app.get("/healthz")
+async def healthz():
+    """连接池健康状态，供运维观察是否打满"""
+    try:
+        connections = app.state.client._transport._pool.connections
+        pool_stats = {
+            "total": len(connections),
+            "idle": sum(1 for c in connections if c.is_idle()),
+        }
+    except AttributeError:
+        # httpx 内部结构变化时健康检查本身不应失败
+        pool_stats = None
+    return {
+        "status": "ok" if is_configured() else "misconfigured",
+        "queued_upserts": _UPSERT_QUEUE.qsize(),
+        "pool": pool_stats,
+    }
+
+
 @app.post("/api/cookies")
-async def receive_cookies(payload: dict):
+async def receive_cookies(payload: CookiePayload):
     if not is_configured():
         raise HTTPException(status_code=500, detail="服务器端 Supabase 未配置")
 
-    # 提取字段
-    psid = payload.get("__Secure-1PSID") or payload.get("secure_1psid")
-    psidts = payload.get("__Secure-1PSIDTS") or payload.get("secure_1psidts")
-    alias = payload.get("alias")
-    proxy = payload.get("proxy")
-    headers = payload.get("headers")
-    timestamp = datetime.now().isoformat()
-
-    if not all([psid, psidts, alias]):
-        raise HTTPException(status_code=400, detail="缺少必要参数: alias, psid, psidts")
-
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 收到更新: {alias}")
-
-    # Upsert Logic using REST API
-    # POST /gemini_accounts (with on_conflict header)
-    # Supabase (PostgREST) supports Upsert via POST with Prefer: resolution=merge-duplicates header
-    
-    upsert_headers = HEADERS.copy()
-    upsert_headers["Prefer"] = "resolution=merge-duplicates,return=representation"
-    
+    alias = payload.alias
+    proxy = payload.proxy
+    headers = payload.headers
+    # 每个请求只读一次墙钟，时间戳和日志时间都从它派生
+    now = datetime.now()
+    timestamp = now.isoformat(timespec="seconds")
+
+    # 热路径日志降级为 debug，默认级别下零格式化开销
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[%s] 收到更新: %s", timestamp[11:], alias)
+
+    # Upsert 入队，由后台 _flusher 攒批后以单次数组 POST
+    # (on_conflict=alias + Prefer: resolution=merge-duplicates) 原子写入。
+    # merge-duplicates 只覆盖 payload 中提供的列，enabled / call_count 不传则
+    # 保持原值（新建时由数据库默认值补齐 enabled=true, call_count=0）。
+
     data = {
         "alias": alias,
-        "psid": psid,
-        "psidts": psidts,
+        "psid": payload.psid,
+        "psidts": payload.psidts,
         "last_updated": timestamp
     }
-    
-    # 因为 REST upsert 是整行合并，有些字段如果不想被覆盖需要注意。
-    # 比如 enabled, call_count。
-    # PostgREST 的 merge-duplicates 会忽略不在 payload 中的列 (PATCH 行为) 还是覆盖 (PUT 行为)?
-    # PostgREST Upsert (POST) 默认会插入，如果冲突则更新。
-    # 为安全起见，我们最好先查询是否存在，就像原来代码做的那样。
-    
-    try:
-        # 1. 检查是否存在
-        query_resp = requests.get(
-            f"{API_URL}/gemini_accounts",
-            headers=HEADERS,
-            params={"alias": f"eq.{alias}"}
-        )
-        existing = query_resp.json() if query_resp.status_code == 200 else []
-        
-        if existing:
-            # 更新
-            update_payload = data  # 基础数据
-            if proxy is not None: update_payload["proxy"] = proxy if proxy else None
-            if headers: update_payload["headers"] = headers
-            
-            # PATCH
-            requests.patch(
-                f"{API_URL}/gemini_accounts",
-                headers=HEADERS,
-                params={"alias": f"eq.{alias}"},
-                json=update_payload
-            )
-            action = "updated"
-        else:
-            # 新建
-            data["proxy"] = proxy
-            data["headers"] = headers
-            data["enabled"] = True
-            data["call_count"] = 0
-            
-            # POST
-            requests.post(
-                f"{API_URL}/gemini_accounts",
-                headers=HEADERS,
-                json=data
-            )
-            action = "created"
+    if proxy is not None:
+        data["proxy"] = proxy if proxy else None
+    if headers:
+        data["headers"] = headers
 
-        return {
-            "status": "success",
-            "action": action,
+    await _UPSERT_QUEUE.put(data)
+
+    return ORJSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "action": "queued",
             "account": {
                 "alias": alias,
                 "has_headers": bool(headers)
             }
         }
+    )
 
-    except Exception as e:
-        print(f"❌ REST API Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
 
+# 列表接口默认投影：省掉体积最大的 headers JSON 列
+_ACCOUNT_COLUMNS = "alias,psid,psidts,proxy,last_updated,enabled,call_count"
+# 取号快照额外带 headers，/api/accounts/next 要原样返回给客户端
+_SNAPSHOT_COLUMNS = _ACCOUNT_COLUMNS + ",headers"
 
-@app.get("/api/accounts")
-async def get_accounts():
-    """
-    获取所有账号列表
-    """
+
+async def _list_accounts(request: Request, cache_key: str, select: Optional[str]):
+    """账号列表的公共实现（TTL 缓存 + ETag，select 控制列投影）"""
     if not is_configured():
         raise HTTPException(status_code=500, detail="Supabase 未配置")
 
     try:
-        resp = requests.get(
-            f"{API_URL}/gemini_accounts",
-            headers=HEADERS,
+        cached = _ACCOUNTS_CACHE.get(cache_key)
+        if cached is None:
             # 排序: order=last_updated.desc.nullslast
-            params={"order": "last_updated.desc.nullslast"}
+            params = {"order": "last_updated.desc.nullslast"}
+            if select:
+                params["select"] = select
+
+            resp = await app.state.client.get("/gemini_accounts", params=params)
+
+            if resp.status_code != 200:
+                raise Exception(f"Failed to list accounts: {resp.text}")
+
+            accounts = resp.json()
+            # 稳定摘要：内置 hash() 按进程随机化（PYTHONHASHSEED），
+            # gunicorn 多 worker 下同一份数据会算出不同 ETag，304 永远打不中
+            etag_src = "|".join(a.get("last_updated") or "" for a in accounts)
+            etag = f'"{hashlib.md5(etag_src.encode()).hexdigest()}"'
+            _ACCOUNTS_CACHE[cache_key] = (accounts, etag)
+        else:
+            accounts, etag = cached
+
+        # 客户端带 If-None-Match 时直接返回 304，省去 JSON 序列化/传输
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        return ORJSONResponse(
+            content={
+                "status": "ok",
+                "count": len(accounts),
+                "accounts": accounts
+            },
+            headers={"ETag": etag}
         )
-        
-        if resp.status_code != 200:
-            raise Exception(f"Failed to list accounts: {resp.text}")
-            
-        accounts = resp.json()
-        
-        return {
-            "status": "ok",
-            "count": len(accounts),
-            "accounts": accounts
-        }
     except Exception as e:
-        print(f"❌ List Error: {e}")
+        logger.error("List Error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/api/accounts")
+async def get_accounts(request: Request):
+    """
+    获取所有账号列表（不含 headers 列，体积小；带 15s TTL 缓存 + ETag）
+    """
+    return await _list_accounts(request, "all", _ACCOUNT_COLUMNS)
+
+
+@app.get("/api/accounts/next")
+async def get_next_account():
+    """
+    轮询取下一个可用账号：纯内存快照 + 自增下标，热路径零 await
+    """
+    snapshot = app.state.accounts_snapshot
+    if not snapshot:
+        raise HTTPException(status_code=503, detail="没有可用账号（快照为空或 Supabase 未配置）")
+
+    app.state.rr_idx = (app.state.rr_idx + 1) % len(snapshot)
+    return {"account": snapshot[app.state.rr_idx]}
+
+
+@app.get("/api/accounts/full")
+async def get_accounts_full(request: Request):
+    """
+    获取所有账号列表（含 headers 列，供确实需要浏览器请求头的调用方）
+    """
+    return await _list_accounts(request, "full", None)
+
+
+# NDJSON 流式端点的分页大小
+_STREAM_PAGE_SIZE = 100
+
+
+@app.get("/api/accounts/stream")
+async def stream_accounts():
+    """
+    以 NDJSON（每行一个账号对象）流式返回全部账号。
+    分页拉取 Supabase，客户端可边收边处理，账号再多内存占用也是平的。
+    """
+    if not is_configured():
+        raise HTTPException(status_code=500, detail="Supabase 未配置")
+
+    async def gen():
+        offset = 0
+        while True:
+            resp = await app.state.client.get(
+                "/gemini_accounts",
+                params={
+                    "order": "last_updated.desc.nullslast",
+                    "limit": str(_STREAM_PAGE_SIZE),
+                    "offset": str(offset),
+                }
+            )
+            if resp.status_code != 200:
+                break
+            page = resp.json()
+            for row in page:
+                yield orjson.dumps(row) + b"\n"
+            if len(page) < _STREAM_PAGE_SIZE:
+                break
+            offset += _STREAM_PAGE_SIZE
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
 if __name__ == "__main__":
+    # 生产环境请用 gunicorn 多 worker 启动（见 run_cookie_bridge.sh），
+    # 单进程 uvicorn 仅用于本地调试（--dev）
+    if "--dev" not in sys.argv:
+        print("生产部署请使用: ./run_cookie_bridge.sh (gunicorn 多 worker)")
+        print("本地调试请使用: python cookie_bridge.py --dev")
+        exit(0)
+
+    # 显式要求 uvloop + httptools，避免静默退回 asyncio selector loop + h11
+    try:
+        import uvloop  # noqa: F401
+        import httptools  # noqa: F401
+    except ImportError:
+        print("请先安装依赖: pip install 'uvicorn[standard]' (需要 uvloop + httptools)")
+        exit(1)
+
     print(f"""
 ╔══════════════════════════════════════════════════════════════╗
 ║     Gemini Cookie Uploader (Supabase REST Edition)            ║
 ╠══════════════════════════════════════════════════════════════╣
-║  本地监听: http://{LOCAL_HOST}:{LOCAL_PORT}                          
-║  数据库  : REST API Mode                                     
+║  本地监听: http://{LOCAL_HOST}:{LOCAL_PORT}
+║  数据库  : REST API Mode
 ╚══════════════════════════════════════════════════════════════╝
     """)
-    uvicorn.run(app, host=LOCAL_HOST, port=LOCAL_PORT)
+    uvicorn.run(
+        app,
+        host=LOCAL_HOST,
+        port=LOCAL_PORT,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        log_level="warning",
+    )
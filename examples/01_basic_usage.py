@@ -19,16 +19,18 @@ sys.path.insert(0, str(SRC_PATH))
 
 from gemini_webapi import GeminiClient
 from gemini_webapi.constants import Model
-from gemini_webapi.account_manager import GeminiAccountManager  # 新增管理器
+from gemini_webapi.account_manager import get_manager  # 新增管理器
 
 # Supabase 配置 (请填入您的配置)
 SUPABASE_URL = os.getenv("SUPABASE_URL", "https://lvpbegckuzmppqcvbtkj.supabase.co")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "sb_secret_y9fn8HzVdDEmUqzttysMHQ_dEzWvD5R")
 
+# 模块级单例：多次取号复用同一个管理器及其底层 HTTP 连接
+_MANAGER = get_manager(SUPABASE_URL, SUPABASE_KEY)
+
 def get_account():
     """使用管理器获取账号"""
-    manager = GeminiAccountManager(SUPABASE_URL, SUPABASE_KEY)
-    return manager.get_next_account()
+    return _MANAGER.get_next_account()
 
 async def example_basic_chat():
     print("=" * 50)
@@ -9,6 +9,7 @@ Gemini API 使用示例 - 多账号轮询篇
 """
 
 import sys
+import json
 import asyncio
 from pathlib import Path
 
@@ -16,43 +17,97 @@ from pathlib import Path
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT / "src"))
 
-import requests
+import httpx
 from gemini_webapi import GeminiClient
 
+# 模块级共享客户端：HTTP/2 多路复用让并行请求共享一条 TCP+TLS 连接
+_CLIENT = httpx.Client(
+    base_url="http://localhost:8001",
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+    transport=httpx.HTTPTransport(http2=True, retries=3),
+)
+
 
 class GeminiPool:
     """
     Gemini 客户端池 - 支持多账号轮询
     """
-    
+
     def __init__(self, server_url: str = "http://localhost:8001"):
         self.server_url = server_url
-    
+        if server_url == "http://localhost:8001":
+            self._client = _CLIENT
+        else:
+            self._client = httpx.Client(
+                base_url=server_url,
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                transport=httpx.HTTPTransport(http2=True, retries=3),
+            )
+        # 已初始化的客户端缓存：{alias: GeminiClient}
+        # init() 的握手开销只在每个账号第一次使用时付一次
+        self._clients: dict[str, GeminiClient] = {}
+        # 每账号一把锁：并发任务轮询到同一账号时，只让第一个 init()，
+        # 其余等待复用，避免重复握手和泄漏被覆盖的客户端
+        self._init_locks: dict[str, asyncio.Lock] = {}
+
     def get_next_account(self):
         """获取下一个可用账号（轮询）"""
-        resp = requests.get(f"{self.server_url}/api/accounts/next")
+        resp = self._client.get("/api/accounts/next")
         if resp.status_code != 200:
             raise Exception(f"获取账号失败: {resp.text}")
         return resp.json()["account"]
-    
+
     def get_all_accounts(self):
-        """获取所有账号"""
-        resp = requests.get(f"{self.server_url}/api/accounts")
-        return resp.json()["accounts"]
-    
-    async def create_client(self, account: dict = None) -> GeminiClient:
-        """创建客户端，不传账号则自动轮询"""
+        """获取所有账号（逐行消费 NDJSON 流，边收边解析）"""
+        accounts = []
+        with self._client.stream("GET", "/api/accounts/stream") as resp:
+            if resp.status_code != 200:
+                raise Exception(f"获取账号列表失败: {resp.read().decode()}")
+            for line in resp.iter_lines():
+                if line:
+                    accounts.append(json.loads(line))
+        return accounts
+    
+    async def get_or_init(self, account: dict = None) -> GeminiClient:
+        """获取已初始化的客户端，不传账号则自动轮询；同账号复用同一个客户端"""
         if account is None:
             account = self.get_next_account()
-        
-        client = GeminiClient(
-            secure_1psid=account["psid"],
-            secure_1psidts=account["psidts"],
-            proxy=account.get("proxy")
-        )
-        await client.init(verbose=False)
+
+        alias = account["alias"]
+        client = self._clients.get(alias)
+        if client is None:
+            lock = self._init_locks.setdefault(alias, asyncio.Lock())
+            async with lock:
+                # 拿到锁后重查：等锁期间可能已有任务完成了初始化
+                client = self._clients.get(alias)
+                if client is None:
+                    client = GeminiClient(
+                        secure_1psid=account["psid"],
+                        secure_1psidts=account["psidts"],
+                        proxy=account.get("proxy")
+                    )
+                    try:
+                        await client.init(verbose=False)
+                    except Exception:
+                        await client.close()
+                        raise
+                    self._clients[alias] = client
         return client
 
+    async def discard(self, alias: str):
+        """账号失效时丢弃对应客户端"""
+        client = self._clients.pop(alias, None)
+        if client:
+            await client.close()
+
+    async def close_all(self):
+        """关闭池中所有客户端"""
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+
 
 async def example_batch_translate():
     """
@@ -71,20 +126,35 @@ async def example_batch_translate():
     ]
     
     pool = GeminiPool()
-    
-    for i, text in enumerate(texts):
-        # 每次获取新账号（轮询）
-        client = await pool.create_client()
-        
-        response = await client.generate_content(
-            f"将以下英文翻译成中文，只输出翻译结果：\n{text}"
+
+    # 并发上限 = 可用账号数，避免请求都压到同一个账号上
+    accounts = pool.get_all_accounts()
+    semaphore = asyncio.Semaphore(max(1, len(accounts)))
+
+    async def translate_one(text: str):
+        async with semaphore:
+            # 轮询账号，同账号复用已初始化的客户端
+            client = await pool.get_or_init()
+            response = await client.generate_content(
+                f"将以下英文翻译成中文，只输出翻译结果：\n{text}"
+            )
+            return response.text
+
+    try:
+        # 并行翻译：总耗时由最慢的一条决定，而不是 5 条串行相加
+        results = await asyncio.gather(
+            *(translate_one(t) for t in texts), return_exceptions=True
         )
-        
+    finally:
+        await pool.close_all()
+
+    for text, result in zip(texts, results):
         print(f"\n原文: {text}")
-        print(f"译文: {response.text}")
-        
-        await client.close()
-    
+        if isinstance(result, Exception):
+            print(f"译文: 失败 ({result})")
+        else:
+            print(f"译文: {result}")
+
     print("\n翻译完成！")
 
 
@@ -115,17 +185,17 @@ async def example_parallel_requests():
     ]
     
     async def ask_question(q: str):
-        client = await pool.create_client()
-        try:
-            response = await client.generate_content(q)
-            return q, response.text
-        finally:
-            await client.close()
-    
+        client = await pool.get_or_init()
+        response = await client.generate_content(q)
+        return q, response.text
+
     # 并行执行
-    tasks = [ask_question(q) for q in questions]
-    results = await asyncio.gather(*tasks)
-    
+    try:
+        tasks = [ask_question(q) for q in questions]
+        results = await asyncio.gather(*tasks)
+    finally:
+        await pool.close_all()
+
     for question, answer in results:
         print(f"\n问题: {question}")
         print(f"回答: {answer[:100]}...")
@@ -144,20 +214,25 @@ async def example_with_retry():
     
     async def safe_generate(prompt: str):
         for attempt in range(max_retries):
+            account = pool.get_next_account()
             try:
-                client = await pool.create_client()
+                client = await pool.get_or_init(account)
                 response = await client.generate_content(prompt)
-                await client.close()
                 return response.text
             except Exception as e:
                 print(f"尝试 {attempt + 1} 失败: {e}")
+                # 账号可能已失效，丢弃对应客户端再切换
+                await pool.discard(account["alias"])
                 if attempt == max_retries - 1:
                     raise
                 print("切换账号重试...")
         return None
-    
-    result = await safe_generate("用一句话介绍中国")
-    print(f"\n结果: {result}")
+
+    try:
+        result = await safe_generate("用一句话介绍中国")
+        print(f"\n结果: {result}")
+    finally:
+        await pool.close_all()
 
 
 async def main():
@@ -15,14 +15,22 @@ from pathlib import Path
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT / "src"))
 
-import requests
+import httpx
 from gemini_webapi import GeminiClient
 from gemini_webapi.constants import Model
 
+# 模块级共享客户端：HTTP/2 多路复用让并行请求共享一条 TCP+TLS 连接
+_CLIENT = httpx.Client(
+    base_url="http://localhost:8001",
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+    transport=httpx.HTTPTransport(http2=True, retries=3),
+)
+
 
 def get_account_with_headers():
     """获取带请求头的账号"""
-    resp = requests.get("http://localhost:8001/api/accounts/next")
+    resp = _CLIENT.get("/api/accounts/next")
     account = resp.json()["account"]
     
     if not account.get("headers"):
@@ -18,10 +18,18 @@ from typing import Optional
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT / "src"))
 
-import requests
+import httpx
 from gemini_webapi import GeminiClient
 from gemini_webapi.constants import Model
 
+# 模块级共享客户端：HTTP/2 多路复用让并行请求共享一条 TCP+TLS 连接
+_CLIENT = httpx.Client(
+    base_url="http://localhost:8001",
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+    transport=httpx.HTTPTransport(http2=True, retries=3),
+)
+
 
 class AIWritingAssistant:
     """AI 写作助手"""
@@ -53,7 +61,7 @@ class AIWritingAssistant:
     
     def _get_next_account(self):
         """获取下一个账号"""
-        resp = requests.get(f"{self.server_url}/api/accounts/next")
+        resp = _CLIENT.get(f"{self.server_url}/api/accounts/next")
         if resp.status_code != 200:
             raise Exception(f"获取账号失败: {resp.text}")
         return resp.json()["account"]
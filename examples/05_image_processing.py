@@ -15,15 +15,17 @@ PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT / "src"))
 
 from gemini_webapi import GeminiClient
-from gemini_webapi.account_manager import GeminiAccountManager
+from gemini_webapi.account_manager import get_manager
 
 # Supabase 配置
 SUPABASE_URL = os.getenv("SUPABASE_URL", "https://lvpbegckuzmppqcvbtkj.supabase.co")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "sb_secret_y9fn8HzVdDEmUqzttysMHQ_dEzWvD5R")
 
+# 模块级单例：多次取号复用同一个管理器及其底层 HTTP 连接
+_MANAGER = get_manager(SUPABASE_URL, SUPABASE_KEY)
+
 def get_account():
-    manager = GeminiAccountManager(SUPABASE_URL, SUPABASE_KEY)
-    return manager.get_next_account()
+    return _MANAGER.get_next_account()
 
 async def example_image_generation(client):
     print("\n" + "=" * 50)
@@ -10,8 +10,12 @@ OpenAI 使用示例
 import os
 import sys
 import base64
+import asyncio
+
+import aiofiles
+import httpx
 from PIL import Image
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 # 配置 OpenAI 客户端指向本地服务
 client = OpenAI(
@@ -19,6 +23,16 @@ client = OpenAI(
     base_url="http://localhost:8001/v1"
 )
 
+# 异步客户端：自带 httpx 连接池，图片上传不阻塞事件循环
+async_client = AsyncOpenAI(
+    api_key="sk-dummy",
+    base_url="http://localhost:8001/v1",
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    ),
+)
+
 def test_chat():
     print("=" * 50)
     print("测试 1: 普通对话")
@@ -76,11 +90,11 @@ def test_image_generation():
     except Exception as e:
         print(f"❌ 图片生成失败: {e}")
 
-def test_image_edit():
+async def test_image_edit():
     print("\n" + "=" * 50)
     print("测试 4: 图生图 (参考生成 / Image Variation)")
     print("=" * 50)
-    
+
     image_path = "D:\gemini\Gemini-API-feat-image-mode-api\static\images\gen_3770e884-5aea-4186-90fa-fd5d9f2bc603.png"
     if not os.path.exists(image_path):
         # Create a simple dummy image if not exists
@@ -90,10 +104,14 @@ def test_image_edit():
 
     prompt = "Make it look like a van gogh painting"
     print(f"Prompt: {prompt} (Reference: {image_path})")
-    
+
     try:
-        response = client.images.edit(
-            image=open(image_path, "rb"),
+        # 异步读文件 + 异步上传：磁盘 I/O 和网络发送可以重叠
+        async with aiofiles.open(image_path, "rb") as f:
+            data = await f.read()
+
+        response = await async_client.images.edit(
+            image=data,
             prompt=prompt,
             model="g3-img-pro",
             n=1,
@@ -164,18 +182,18 @@ def test_multi_image_edit():
         print(f"❌ 多图参考生成失败: {e}")
 
 
-def main():
+async def main():
     try:
         #test_chat()
-        # test_stream_chat() 
+        # test_stream_chat()
         #test_image_generation()
-        #test_image_edit() # 图生图（参考生成）
+        #await test_image_edit() # 图生图（参考生成）
         test_multi_image_edit() # 多图参考生成
 
-        
+
     except Exception as e:
         print(f"\n❌ 连接失败: {e}")
         print("请确保 'openai_server.py' 正在运行 (端口 8001)")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
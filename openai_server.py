@@ -13,10 +13,12 @@ pip install fastapi uvicorn sse-starlette
 
 import sys
 import time
-import json
 import uuid
+import heapq
+import itertools
 import asyncio
 import os
+import tempfile
 from pathlib import Path
 from typing import List, Optional, Union, Dict, Any, Tuple
 
@@ -28,12 +30,12 @@ sys.path.insert(0, str(SRC_PATH))
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from sse_starlette.sse import EventSourceResponse
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 import uvicorn
 import shutil
 
 from gemini_webapi import GeminiClient, ImageMode
-from gemini_webapi.account_manager import GeminiAccountManager
+from gemini_webapi.account_manager import get_manager
 from gemini_webapi.constants import Model
 # ================= Configuration =================
 HOST = "0.0.0.0"
@@ -67,51 +69,122 @@ FILE_EXPIRY_SECONDS = IMAGE_EXPIRY_HOURS * 3600
 # --- OpenAI Models ---
 # ... imports ...
 
+# Time-indexed registry of written files: (expire_at, path) min-heap.
+# Cleanup pops only the expired head entries instead of stat-ing the whole
+# directory every pass.
+_file_expiry: list = []
+
+def register_temp_file(path) -> None:
+    """Schedule a freshly written file for expiry-based cleanup."""
+    heapq.heappush(_file_expiry, (time.time() + FILE_EXPIRY_SECONDS, str(path)))
+
 async def cleanup_old_files():
-    """Background task to delete expired files."""
+    """Background task to delete expired files from the expiry heap."""
+    # Seed the heap once from files already on disk (e.g. after a restart)
+    directory = "static/images"
+    if os.path.exists(directory):
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            if os.path.isfile(file_path):
+                heapq.heappush(
+                    _file_expiry,
+                    (os.path.getmtime(file_path) + FILE_EXPIRY_SECONDS, file_path)
+                )
+
     while True:
         try:
-            # print("🧹 Running image cleanup check...") 
             now = time.time()
-            directory = "static/images"
-            if os.path.exists(directory):
-                count = 0
-                for filename in os.listdir(directory):
-                    file_path = os.path.join(directory, filename)
-                    if os.path.isfile(file_path):
-                        if (now - os.path.getmtime(file_path)) > FILE_EXPIRY_SECONDS:
-                            try:
-                                os.remove(file_path)
-                                count += 1
-                            except Exception as e:
-                                print(f"❌ Failed to delete {filename}: {e}")
-                if count > 0:
-                    print(f"🧹 Cleaned up {count} expired images (> {IMAGE_EXPIRY_HOURS}h).")
+            count = 0
+            while _file_expiry and _file_expiry[0][0] <= now:
+                _, file_path = heapq.heappop(_file_expiry)
+                try:
+                    await asyncio.to_thread(os.remove, file_path)
+                    count += 1
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print(f"❌ Failed to delete {file_path}: {e}")
+            if count > 0:
+                print(f"🧹 Cleaned up {count} expired images (> {IMAGE_EXPIRY_HOURS}h).")
         except Exception as e:
             print(f"❌ Cleanup task error: {e}")
-        
-        await asyncio.sleep(CLEANUP_INTERVAL)
+
+        # Sleep until the next scheduled expiry instead of a fixed interval;
+        # fall back to the coarse interval while nothing is registered.
+        if _file_expiry:
+            sleep_for = max(1.0, _file_expiry[0][0] - time.time())
+        else:
+            sleep_for = CLEANUP_INTERVAL
+        await asyncio.sleep(sleep_for)
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(cleanup_old_files())
+    # Keep a strong reference: bare create_task results can be GC'd mid-run
+    app.state.cleanup_task = asyncio.create_task(cleanup_old_files())
+
+@app.on_event("shutdown")
+async def stop_cleanup_task():
+    app.state.cleanup_task.cancel()
+    try:
+        await app.state.cleanup_task
+    except asyncio.CancelledError:
+        pass
 
 # Ensure static directory exists
 os.makedirs("static/images", exist_ok=True)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-def save_image_locally(image_data: bytes, filename: str) -> str:
+# --- Static serving ---
+# In production put Nginx (or any reverse proxy) in front and let it serve
+# /static via kernel sendfile, so image downloads never touch the Python
+# event loop:
+#
+#     location /static/ {
+#         alias /app/static/;
+#         sendfile on;
+#         aio on;
+#     }
+#
+# Then set SERVE_STATIC=0 to drop the in-process mount and PUBLIC_BASE_URL
+# (e.g. https://api.example.com) so returned image URLs stay valid behind
+# the proxy. Without a proxy the defaults keep the standalone behavior.
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+
+if os.getenv("SERVE_STATIC", "1") == "1":
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+
+def public_base_url(req: Optional[Request] = None) -> str:
+    """Base URL for returned image links, proxy-aware via PUBLIC_BASE_URL."""
+    if PUBLIC_BASE_URL:
+        return f"{PUBLIC_BASE_URL}/"
+    if req:
+        return str(req.base_url)
+    return f"http://{HOST}:{PORT}/"
+
+async def save_image_locally(image_data: bytes, filename: str) -> str:
     """Save image bytes to static dir and return relative URL."""
     file_path = f"static/images/{filename}"
-    with open(file_path, "wb") as f:
-        f.write(image_data)
+    async with aiofiles.open(file_path, "wb") as f:
+        await f.write(image_data)
+    register_temp_file(file_path)
     # Return full URL if possible, or relative. OpenAI clients usually expect full URL.
     # We will construct it in the route handler using request.base_url
     return f"static/images/{filename}"
 
 import base64
-import requests
+import aiofiles
+import httpx
+from PIL import Image as PILImage
+
+# Shared client for outbound image downloads: pooled keep-alive
+# connections, reused across all requests.
+_shared_httpx = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=300,
+    ),
+    follow_redirects=True,
+)
 
 class ChatMessage(BaseModel):
     role: str
@@ -139,70 +212,252 @@ class ModelList(BaseModel):
     object: str = "list"
     data: List[Dict[str, Any]] = []
 
+class ChunkChoice(BaseModel):
+    index: int = 0
+    delta: Dict[str, Any] = {}
+    finish_reason: Optional[str] = None
+
+class ChatCompletionChunk(BaseModel):
+    id: str
+    object: str = "chat.completion.chunk"
+    created: int
+    model: str
+    choices: List[ChunkChoice]
+
 # --- Helper Functions ---
 
-def get_gemini_client():
-    """Get an initialized Gemini client using rotation."""
-    manager = GeminiAccountManager(SUPABASE_URL, SUPABASE_KEY)
+# Shared account manager: the memoized factory guarantees one instance
+# (and one connection pool) per process, even if other modules ask too.
+_account_manager = get_manager(SUPABASE_URL, SUPABASE_KEY)
+
+# Pool of initialized clients keyed by account alias. init() performs an
+# auth round-trip, so clients are leased out and recycled instead of being
+# constructed and closed on every request.
+_client_pool: Dict[str, asyncio.Queue] = {}
+_pool_lock = asyncio.Lock()
+
+# Circuit breaker: alias -> epoch until which the account is considered
+# throttled. Acquire skips these so a rate-limited account isn't hammered
+# from every endpoint.
+_throttle_until: Dict[str, float] = {}
+
+async def _acquire_client() -> Tuple[str, GeminiClient]:
+    """Pick the next non-throttled account and lease an initialized client."""
+    account = None
+    for _ in range(5):
+        try:
+            # Async lookup: the Supabase round-trip no longer blocks the
+            # event loop under concurrent requests.
+            account = await _account_manager.aget_next_account()
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"No available accounts: {e}")
+        if _throttle_until.get(account["alias"], 0) <= time.time():
+            break
+        # else: throttled — rotate to the next account (last pick wins if
+        # everything is throttled)
+
+    alias = account["alias"]
+    print(f"🔹 Using account: {alias}")
+
+    async with _pool_lock:
+        queue = _client_pool.setdefault(alias, asyncio.Queue())
+
     try:
-        account = manager.get_next_account()
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"No available accounts: {e}")
-    
-    print(f"🔹 Using account: {account['alias']}")
-    client = GeminiClient(
-        secure_1psid=account["psid"],
-        secure_1psidts=account["psidts"],
-        proxy=account.get("proxy"),
-        headers=account.get("headers")
-    )
-    return client
+        client = queue.get_nowait()
+    except asyncio.QueueEmpty:
+        client = GeminiClient(
+            secure_1psid=account["psid"],
+            secure_1psidts=account["psidts"],
+            proxy=account.get("proxy"),
+            headers=account.get("headers")
+        )
+        try:
+            await client.init()
+        except Exception as e:
+            print(f"❌ Init failed: {e}")
+            await client.close()
+            raise HTTPException(status_code=500, detail="Failed to initialize Gemini client")
+    return alias, client
 
-async def init_client(client: GeminiClient):
+def _release_client(alias: str, client: GeminiClient):
+    """Return a healthy client to its per-alias pool."""
+    _client_pool[alias].put_nowait(client)
+
+async def _discard_client(client: GeminiClient):
+    """Close a client that failed mid-request instead of recycling it."""
     try:
-        await client.init()
-    except Exception as e:
-        print(f"❌ Init failed: {e}")
         await client.close()
-        raise HTTPException(status_code=500, detail="Failed to initialize Gemini client")
+    except Exception:
+        pass
+
+@app.on_event("shutdown")
+async def close_client_pool():
+    for queue in _client_pool.values():
+        while not queue.empty():
+            await _discard_client(queue.get_nowait())
+    _client_pool.clear()
+    await _shared_httpx.aclose()
+
+# --- Shared rate-limit retry ---
+
+_RATE_LIMIT_MARKERS = ("ask me again later", "more images than usual")
+
+def _is_rate_limited(text: str) -> bool:
+    lowered = text.lower()
+    return any(marker in lowered for marker in _RATE_LIMIT_MARKERS)
+
+class _RateLimited(Exception):
+    """Gemini answered but refused the generation due to throttling."""
+
+def _raise_for_empty(response):
+    """Classify a generation that returned no images."""
+    error_text = response.text or "No image generated"
+    if _is_rate_limited(error_text):
+        raise _RateLimited(error_text)
+    raise HTTPException(status_code=400, detail=error_text)
+
+async def retry_rate_limited(op, *, label: str, max_retries: int = 3, base_delay: float = 5):
+    """
+    Run `op(client)` with a fresh leased client per attempt, retrying on
+    Gemini rate-limit responses with exponential backoff (5s, 10s, 20s).
+    A throttled account is marked in `_throttle_until` for the backoff
+    window so the next attempt (and every other endpoint) rotates past it.
+    """
+    last_error = None
+
+    for attempt in range(1, max_retries + 1):
+        alias, client = await _acquire_client()
+        try:
+            result = await op(client)
+        except HTTPException:
+            _release_client(alias, client)
+            raise
+        except _RateLimited as e:
+            _release_client(alias, client)  # client is healthy, account is throttled
+            last_error = str(e)
+        except Exception as e:
+            error_str = str(e)
+            if not _is_rate_limited(error_str):
+                print(f"❌ {label} Error: {e}")
+                await _discard_client(client)
+                raise HTTPException(status_code=500, detail=error_str)
+            await _discard_client(client)
+            last_error = error_str
+        else:
+            _release_client(alias, client)
+            return result
+
+        delay = base_delay * 2 ** (attempt - 1)
+        _throttle_until[alias] = time.time() + delay
+        print(f"⚠️ Rate limited on {alias} (attempt {attempt}/{max_retries}), backing off {delay:.0f}s...")
+        if attempt < max_retries:
+            await asyncio.sleep(delay)
+
+    print(f"❌ {label} Failed after {max_retries} retries")
+    raise HTTPException(status_code=500, detail=f"Rate limited after {max_retries} retries: {last_error}")
+
+async def _save_generated_images(response, prefix: str, revised_prompt: str, req: Optional[Request]):
+    """Persist response images and build the OpenAI-style payload."""
+    data = []
+    for img in response.images:
+        filename = f"{prefix}_{uuid.uuid4()}.png"
+        await img.save(path="static/images", filename=filename, skip_invalid_filename=True)
+        register_temp_file(f"static/images/{filename}")
+
+        data.append({
+            "url": f"{public_base_url(req)}static/images/{filename}",
+            "revised_prompt": revised_prompt
+        })
+
+    return {
+        "created": int(time.time()),
+        "data": data
+    }
+
+async def process_base64_image(base64_string: str, out_dir: Optional[str] = None) -> str:
+    """Decode base64 image to temp file.
+
+    The data-URI prefix is skipped with one find + zero-copy slice instead
+    of split() (which copies both halves of a potentially multi-MB string),
+    so peak memory stays near the decoded size.
+    """
+    buf = base64_string.encode("ascii")
+    idx = buf.find(b"base64,")
+    if idx != -1:
+        buf = memoryview(buf)[idx + 7:]
+
+    file_path = _temp_name("temp_chat_img", dir=out_dir)
+
+    async with aiofiles.open(file_path, "wb") as f:
+        await f.write(base64.b64decode(buf))
 
-def process_base64_image(base64_string: str) -> str:
-    """Decode base64 image to temp file."""
-    if "base64," in base64_string:
-        base64_string = base64_string.split("base64,")[1]
-    
-    image_data = base64.b64decode(base64_string)
-    file_path = f"temp_chat_img_{uuid.uuid4()}.png"
-    
-    with open(file_path, "wb") as f:
-        f.write(image_data)
-        
     return file_path
 
-def process_url_image(url: str) -> str:
-    """Download image from URL to temp file."""
+# Cheap collision-free names for per-request temp files: a process-unique
+# counter beats uuid4's os.urandom(16) + formatting on the hot path.
+_temp_name_counter = itertools.count()
+
+def _temp_name(prefix: str, dir: Optional[str] = None) -> str:
+    name = f"{prefix}_{os.getpid()}_{time.monotonic_ns()}_{next(_temp_name_counter)}.png"
+    return os.path.join(dir, name) if dir else name
+
+def _save_upload(src, dst_path: str):
+    """Copy an upload stream to disk with a 1 MB buffer, then verify it is
+    a decodable image while the file is still hot in the page cache. Runs
+    in a worker thread so multi-MB uploads never hold up the event loop
+    and never sit fully in memory. Corrupt uploads are rejected with a 400
+    before a Gemini request is spent on them."""
+    with open(dst_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=1 << 20)
+    try:
+        with PILImage.open(dst_path) as im:
+            im.verify()
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid image upload")
+
+def _parse_size(size: str, default: int = 1024) -> int:
+    """Parse the longest edge out of an OpenAI-style "1024x1024" size."""
+    try:
+        return max(int(x) for x in size.lower().split("x"))
+    except (AttributeError, ValueError):
+        return default
+
+def _resize_if_large(path: str, target: int):
+    """Downscale an oversized upload in place. Runs in a worker thread."""
+    with PILImage.open(path) as im:
+        if max(im.size) > target:
+            im.thumbnail((target, target), PILImage.LANCZOS)
+            im.save(path, optimize=True)
+
+async def process_url_image(url: str, out_dir: Optional[str] = None) -> str:
+    """Download image from URL to temp file without blocking the event loop."""
     # Safety check/Size check omitted for brevity
-    resp = requests.get(url, stream=True)
-    if resp.status_code == 200:
-        file_path = f"temp_chat_img_{uuid.uuid4()}.png"
-        with open(file_path, "wb") as f:
-            resp.raw.decode_content = True
-            shutil.copyfileobj(resp.raw, f)
-        return file_path
+    async with _shared_httpx.stream("GET", url) as resp:
+        if resp.status_code == 200:
+            file_path = _temp_name("temp_chat_img", dir=out_dir)
+            async with aiofiles.open(file_path, "wb") as f:
+                async for chunk in resp.aiter_bytes(65536):
+                    await f.write(chunk)
+            return file_path
     raise Exception(f"Failed to download image: {url}")
 
-def extract_content_and_files(messages: List[ChatMessage]) -> Tuple[str, List[str]]:
+async def extract_content_and_files(
+    messages: List[ChatMessage], out_dir: Optional[str] = None
+) -> Tuple[str, List[str]]:
     """
     Parse OpenAI messages to get prompt text and file paths.
     Supports GPT-4V format.
+
+    Image parts are fetched/decoded concurrently: the scan only schedules
+    tasks, then one gather overlaps all downloads so N images cost ~1 RTT.
     """
     full_prompt = ""
-    files = []
-    
+    tasks: List[asyncio.Task] = []
+
     for msg in messages:
         role_label = msg.role.capitalize()
         content = msg.content
-        
+
         if isinstance(content, str):
             full_prompt += f"{role_label}: {content}\n"
         elif isinstance(content, list):
@@ -214,14 +469,17 @@ def extract_content_and_files(messages: List[ChatMessage]) -> Tuple[str, List[st
                 elif part.get("type") == "image_url":
                     img_url = part.get("image_url", {}).get("url", "")
                     if img_url.startswith("data:"):
-                        files.append(process_base64_image(img_url))
+                        tasks.append(asyncio.create_task(process_base64_image(img_url, out_dir)))
                     elif img_url.startswith("http"):
-                        files.append(process_url_image(img_url))
+                        tasks.append(asyncio.create_task(process_url_image(img_url, out_dir)))
                     else:
                         # Local path?
                         pass
                     full_prompt += "[Image]\n"
-        
+
+    # Task order matches scan order, so files line up with the [Image] markers
+    files = list(await asyncio.gather(*tasks)) if tasks else []
+
     return full_prompt, files
 
 # --- Routes ---
@@ -230,68 +488,17 @@ def extract_content_and_files(messages: List[ChatMessage]) -> Tuple[str, List[st
 async def generate_images(request: ImageGenerationRequest, req: Request):
     """
     Handle Text-to-Image generation.
-    Includes retry logic for rate limit errors.
+    Rate-limit retries are handled by `retry_rate_limited`.
     """
-    MAX_RETRIES = 3
-    RETRY_DELAY = 5  # seconds
-    
     print(f"🎨 Image Gen Prompt: {request.prompt} (Model: {request.model})")
-    
-    last_error = None
-    
-    for attempt in range(1, MAX_RETRIES + 1):
-        client = None
-        try:
-            client = get_gemini_client()
-            await init_client(client)
-            
-            response = await client.generate_content(request.prompt, image_mode=ImageMode.PRO)
-            
-            data = []
-            if response.images:
-                for img in response.images:
-                    filename = f"gen_{uuid.uuid4()}.png"
-                    await img.save(path="static/images", filename=filename, skip_invalid_filename=True)
-                    
-                    local_url = f"{req.base_url}static/images/{filename}"
-                    
-                    data.append({
-                        "url": local_url,
-                        "revised_prompt": request.prompt
-                    })
-                    
-                return {
-                    "created": int(time.time()),
-                    "data": data
-                }
-            else:
-                error_text = response.text or "No image generated"
-                if "ask me again later" in error_text.lower() or "more images than usual" in error_text.lower():
-                    print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                    last_error = error_text
-                    await asyncio.sleep(RETRY_DELAY)
-                    continue
-                else:
-                    raise HTTPException(status_code=400, detail=error_text)
-                
-        except HTTPException:
-            raise
-        except Exception as e:
-            error_str = str(e)
-            if "ask me again later" in error_str.lower() or "more images than usual" in error_str.lower():
-                print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                last_error = error_str
-                await asyncio.sleep(RETRY_DELAY)
-                continue
-            else:
-                print(f"❌ Image Gen Error: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
-        finally:
-            if client:
-                await client.close()
-    
-    print(f"❌ Image Gen Failed after {MAX_RETRIES} retries")
-    raise HTTPException(status_code=500, detail=f"Rate limited after {MAX_RETRIES} retries: {last_error}")
+
+    async def op(client):
+        response = await client.generate_content(request.prompt, image_mode=ImageMode.PRO)
+        if not response.images:
+            _raise_for_empty(response)
+        return await _save_generated_images(response, "gen", request.prompt, req)
+
+    return await retry_rate_limited(op, label="Image Gen")
 
 @app.post("/v1/images/edits")
 async def edit_image(
@@ -308,79 +515,33 @@ async def edit_image(
     """
     Handle Image-to-Image (Edit).
     Maps to Gemini Chat with file upload.
-    Includes retry logic for rate limit errors.
+    Rate-limit retries are handled by `retry_rate_limited`.
     """
-    MAX_RETRIES = 3
-    RETRY_DELAY = 5  # seconds
-    
-    # Save uploaded file first (only once)
-    temp_path = Path(f"static/images/upload_{uuid.uuid4()}.png")
-    with open(temp_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-        
-    print(f"🎨 Image Edit Prompt: {prompt} (File: {temp_path}, Model: {model})")
-    
-    last_error = None
-    
-    for attempt in range(1, MAX_RETRIES + 1):
-        client = None
-        try:
-            client = get_gemini_client()
-            await init_client(client)
-            
+    # Stage the upload in a per-request temp directory: it is removed
+    # atomically when the request finishes, crash or not, instead of
+    # relying on the expiry sweep to find it under static/images.
+    with tempfile.TemporaryDirectory(prefix="editreq_") as td:
+        temp_path = _temp_name("upload", dir=td)
+        await asyncio.to_thread(_save_upload, image.file, temp_path)
+
+        # Oversized uploads cost bandwidth quadratically with resolution —
+        # downscale to the requested size before shipping to Gemini
+        await asyncio.to_thread(_resize_if_large, temp_path, _parse_size(size))
+
+        print(f"🎨 Image Edit Prompt: {prompt} (File: {temp_path}, Model: {model})")
+
+        async def op(client):
             chat = client.start_chat()
             response = await chat.send_message(
                 prompt,
-                files=[str(temp_path)],
+                files=[temp_path],
                 image_mode=ImageMode.PRO
             )
-            
-            data = []
-            if response.images:
-                for img in response.images:
-                    filename = f"edit_{uuid.uuid4()}.png"
-                    await img.save(path="static/images", filename=filename, skip_invalid_filename=True)
-                    
-                    base_url = str(req.base_url) if req else f"http://{HOST}:{PORT}/"
-                    local_url = f"{base_url}static/images/{filename}"
-
-                    data.append({
-                        "url": local_url,
-                        "revised_prompt": prompt
-                    })
-                    
-                return {
-                    "created": int(time.time()),
-                    "data": data
-                }
-            else:
-                error_text = response.text or "No image generated"
-                if "ask me again later" in error_text.lower() or "more images than usual" in error_text.lower():
-                    print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                    last_error = error_text
-                    await asyncio.sleep(RETRY_DELAY)
-                    continue
-                else:
-                    raise HTTPException(status_code=400, detail=error_text)
+            if not response.images:
+                _raise_for_empty(response)
+            return await _save_generated_images(response, "edit", prompt, req)
 
-        except HTTPException:
-            raise
-        except Exception as e:
-            error_str = str(e)
-            if "ask me again later" in error_str.lower() or "more images than usual" in error_str.lower():
-                print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                last_error = error_str
-                await asyncio.sleep(RETRY_DELAY)
-                continue
-            else:
-                print(f"❌ Image Edit Error: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
-        finally:
-            if client:
-                await client.close()
-    
-    print(f"❌ Image Edit Failed after {MAX_RETRIES} retries")
-    raise HTTPException(status_code=500, detail=f"Rate limited after {MAX_RETRIES} retries: {last_error}")
+        return await retry_rate_limited(op, label="Image Edit")
 
 @app.post("/v1/images/edits/multi")
 async def edit_image_multi(
@@ -396,116 +557,71 @@ async def edit_image_multi(
     """
     Handle Image-to-Image with MULTIPLE reference images.
     Upload multiple images and generate a new one based on them.
-    Includes retry logic for rate limit errors.
+    Rate-limit retries are handled by `retry_rate_limited`.
     """
-    MAX_RETRIES = 3
-    RETRY_DELAY = 5  # seconds
-    
-    temp_paths = []
-    
-    # Save all uploaded files first (only once)
-    for image in images:
-        temp_path = Path(f"static/images/upload_{uuid.uuid4()}.png")
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        temp_paths.append(str(temp_path))
-    
-    print(f"🎨 Multi-Image Edit Prompt: {prompt} (Files: {len(temp_paths)}, Model: {model})")
-    
-    last_error = None
-    
-    for attempt in range(1, MAX_RETRIES + 1):
-        client = None
-        try:
-            client = get_gemini_client()
-            await init_client(client)
-            
+    # Stage all uploads in one per-request temp directory (removed
+    # atomically on exit), streamed in parallel off the event loop
+    with tempfile.TemporaryDirectory(prefix="editreq_") as td:
+        temp_paths = [_temp_name("upload", dir=td) for _ in images]
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(_save_upload, img.file, p)
+                for img, p in zip(images, temp_paths)
+            )
+        )
+
+        # Downscale any oversized references in parallel before upload
+        target = _parse_size(size)
+        await asyncio.gather(
+            *(asyncio.to_thread(_resize_if_large, p, target) for p in temp_paths)
+        )
+
+        print(f"🎨 Multi-Image Edit Prompt: {prompt} (Files: {len(temp_paths)}, Model: {model})")
+
+        async def op(client):
             chat = client.start_chat()
             response = await chat.send_message(
                 prompt,
                 files=temp_paths,
                 image_mode=ImageMode.PRO
             )
-            
-            data = []
-            if response.images:
-                for img in response.images:
-                    # Save locally
-                    filename = f"edit_{uuid.uuid4()}.png"
-                    await img.save(path="static/images", filename=filename, skip_invalid_filename=True)
-                    
-                    # Construct local URL
-                    base_url = str(req.base_url) if req else f"http://{HOST}:{PORT}/"
-                    local_url = f"{base_url}static/images/{filename}"
-
-                    data.append({
-                        "url": local_url,
-                        "revised_prompt": prompt
-                    })
-                    
-                return {
-                    "created": int(time.time()),
-                    "data": data
-                }
-            else:
-                # Check if it's a rate limit / overload error
-                error_text = response.text or "No image generated"
-                if "ask me again later" in error_text.lower() or "more images than usual" in error_text.lower():
-                    print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                    last_error = error_text
-                    await asyncio.sleep(RETRY_DELAY)
-                    continue
-                else:
-                    raise HTTPException(status_code=400, detail=error_text)
-
-        except HTTPException:
-            raise
-        except Exception as e:
-            error_str = str(e)
-            # Check if retriable error
-            if "ask me again later" in error_str.lower() or "more images than usual" in error_str.lower():
-                print(f"⚠️ Rate limited (attempt {attempt}/{MAX_RETRIES}), retrying in {RETRY_DELAY}s...")
-                last_error = error_str
-                await asyncio.sleep(RETRY_DELAY)
-                continue
-            else:
-                print(f"❌ Multi-Image Edit Error: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
-        finally:
-            if client:
-                await client.close()
-    
-    # All retries exhausted
-    print(f"❌ Multi-Image Edit Failed after {MAX_RETRIES} retries")
-    raise HTTPException(status_code=500, detail=f"Rate limited after {MAX_RETRIES} retries: {last_error}")
+            if not response.images:
+                _raise_for_empty(response)
+            return await _save_generated_images(response, "edit", prompt, req)
+
+        return await retry_rate_limited(op, label="Multi-Image Edit")
+
+# We map Gemini models to OpenAI names for compatibility, plus real names.
+# The catalog is static, so build the response once at import (discovery
+# tools poll /v1/models aggressively).
+_MODELS_CREATED = int(time.time())
+_MODEL_LIST = ModelList(data=[
+    {"id": "gpt-3.5-turbo", "object": "model", "created": _MODELS_CREATED, "owned_by": "gemini-proxy"},
+    {"id": "gpt-4", "object": "model", "created": _MODELS_CREATED, "owned_by": "gemini-proxy"},
+    {"id": "gemini-2.5-flash", "object": "model", "created": _MODELS_CREATED, "owned_by": "google"},
+    {"id": "gemini-2.5-pro", "object": "model", "created": _MODELS_CREATED, "owned_by": "google"},
+    {"id": "g3-img-pro", "object": "model", "created": _MODELS_CREATED, "owned_by": "google"},
+])
 
 @app.get("/v1/models")
 async def list_models():
     """List available models."""
-    # We map Gemini models to OpenAI names for compatibility, plus real names
-    timestamp = int(time.time())
-    models = [
-        {"id": "gpt-3.5-turbo", "object": "model", "created": timestamp, "owned_by": "gemini-proxy"},
-        {"id": "gpt-4", "object": "model", "created": timestamp, "owned_by": "gemini-proxy"},
-        {"id": "gemini-2.5-flash", "object": "model", "created": timestamp, "owned_by": "google"},
-        {"id": "gemini-2.5-pro", "object": "model", "created": timestamp, "owned_by": "google"},
-        {"id": "g3-img-pro", "object": "model", "created": timestamp, "owned_by": "google"},
-    ]
-    return ModelList(data=models)
+    return _MODEL_LIST
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: ChatCompletionRequest):
     """Handle chat completions (Text & Multimodal)."""
     
-    # 1. Setup Client
-    client = get_gemini_client()
-    await init_client(client)
-    
-    temp_files = []
-    
+    # 1. Lease a pooled client
+    alias, client = await _acquire_client()
+
+    # All request-scoped image inputs live in one temp directory; a single
+    # cleanup() removes them atomically even if the request dies mid-way.
+    tmpdir = tempfile.TemporaryDirectory(prefix="chatreq_", ignore_cleanup_errors=True)
+
     try:
         # 2. Process Messages (Text + Images)
-        full_prompt, temp_files = extract_content_and_files(request.messages)
+        full_prompt, temp_files = await extract_content_and_files(request.messages, out_dir=tmpdir.name)
         
         print(f"📝 Prompt length: {len(full_prompt)}, Files: {len(temp_files)}")
         
@@ -519,32 +635,48 @@ async def chat_completions(request: ChatCompletionRequest):
             # Our stream_generator pseudo-implementation calls send_message.
             # We need to update stream_generator to accept files.
             
-            async def cleanup_generator():
-                gen = stream_generator(client, chat, full_prompt, request.model, files=temp_files)
+            # Bind the lease under its own name: the route's `client` local
+            # is cleared below, and the generator must not see that.
+            async def cleanup_generator(leased=client):
+                gen = stream_generator(leased, chat, full_prompt, request.model, files=temp_files)
+                # Client disconnects surface as CancelledError/GeneratorExit,
+                # which `except Exception` would miss — settle ownership in
+                # the finally so the lease can never leak mid-stream.
+                completed = False
                 try:
                     async for item in gen:
                         yield item
+                    completed = True
                 finally:
-                    # Clean up temp files after stream
-                    for f in temp_files:
-                        if os.path.exists(f): os.remove(f)
-
-            return EventSourceResponse(cleanup_generator())
+                    if completed:
+                        _release_client(alias, leased)
+                    else:
+                        await _discard_client(leased)
+                    # Drop the whole input staging dir after the stream
+                    tmpdir.cleanup()
+
+            # ping keeps proxies from timing out during long generations
+            response = EventSourceResponse(cleanup_generator(), ping=15)
+            # Ownership of the client (and tmpdir) moves to the generator;
+            # clear the local so the except path can't discard it a second
+            # time after the generator has already recycled it.
+            client = None
+            return response
         else:
             response = await chat.send_message(full_prompt, files=temp_files)
-            
+
             # Cleanup immediately for non-stream
-            for f in temp_files:
-                if os.path.exists(f): os.remove(f)
-                
+            tmpdir.cleanup()
+
+            _release_client(alias, client)
+            client = None  # back in the pool — no longer ours to discard
             return format_response(response, request.model)
 
     except Exception as e:
         print(f"❌ Error: {e}")
-        # Try cleanup
-        for f in temp_files:
-            if os.path.exists(f): os.remove(f)
-        await client.close()
+        tmpdir.cleanup()
+        if client is not None:
+            await _discard_client(client)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -552,46 +684,43 @@ async def stream_generator(client, chat, message, model, files=None):
     """
     Yields SSE events for streaming.
     """
-    try:
-        request_id = f"chatcmpl-{uuid.uuid4()}"
-        created = int(time.time())
-        
-        # Pass files to Gemini
-        response = await chat.send_message(message, files=files or [])
-        text = response.text
-        
-        # Chunk logic
-        chunk_size = 10
+    request_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time())
+
+    # Pass files to Gemini
+    # gemini_webapi has no token-level streaming (the web API answers via a
+    # single batchexecute response), so the text is forwarded the moment it
+    # arrives. It is sliced into a few adaptively sized deltas — chunk size
+    # scales with output length so SSE framing overhead stays bounded — with
+    # no artificial sleeps between frames; clients flush per event already.
+    response = await chat.send_message(message, files=files or [])
+    text = response.text
+
+    if text:
+        chunk_size = max(32, len(text) // 64)
         for i in range(0, len(text), chunk_size):
-            chunk = text[i:i+chunk_size]
-            yield format_stream_chunk(request_id, created, model, chunk)
-            await asyncio.sleep(0.01) 
-            
-        yield format_stream_chunk(request_id, created, model, "", finish_reason="stop")
-        yield "[DONE]"
-        
-    finally:
-        await client.close()
+            yield format_stream_chunk(request_id, created, model, text[i:i + chunk_size])
+
+    yield format_stream_chunk(request_id, created, model, "", finish_reason="stop")
+    yield ServerSentEvent(data="[DONE]")
 
 
 
 
 def format_stream_chunk(id, created, model, content, finish_reason=None):
-    """Format data for SSE."""
-    data = {
-        "id": id,
-        "object": "chat.completion.chunk",
-        "created": created,
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"content": content} if content else {},
-                "finish_reason": finish_reason
-            }
+    """Format a chunk as an SSE event, serialized by pydantic-core (Rust)."""
+    chunk = ChatCompletionChunk(
+        id=id,
+        created=created,
+        model=model,
+        choices=[
+            ChunkChoice(
+                delta={"content": content} if content else {},
+                finish_reason=finish_reason
+            )
         ]
-    }
-    return json.dumps(data)
+    )
+    return ServerSentEvent(data=chunk.model_dump_json())
 
 def format_response(gemini_resp, model):
     """Format full JSON response."""
@@ -619,4 +748,17 @@ def format_response(gemini_resp, model):
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=HOST, port=PORT)
+    # uvloop + httptools for the fast event loop / HTTP parser path, and
+    # multiple workers so JSON serialization doesn't bottleneck on one core.
+    # Module-level singletons (account manager, client pool) are per-process,
+    # so each forked worker gets its own.
+    uvicorn.run(
+        "openai_server:app",
+        host=HOST,
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        log_level="warning",
+        access_log=False,
+    )
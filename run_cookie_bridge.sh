@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+# Cookie 上传器生产启动脚本
+# gunicorn 预派生多进程 + 每个 worker 内部跑 uvloop 异步循环，
+# 突发上传时吞吐随 worker 数线性扩展。
+# 本地调试请用: python cookie_bridge.py --dev
+exec gunicorn cookie_bridge:app \
+    -k uvicorn.workers.UvicornWorker \
+    -w "${WORKERS:-4}" \
+    -b 0.0.0.0:8002 \
+    --worker-tmp-dir /dev/shm \
+    --keep-alive 30
@@ -8,10 +8,54 @@ create table if not exists gemini_accounts (
   headers jsonb,
   enabled boolean default true,
   call_count bigint default 0,
-  last_used timestamptz,
+  last_used timestamptz default now(),
   last_updated timestamptz
 );
 
 -- 创建索引以优化轮询查询
 create index if not exists idx_gemini_accounts_call_count on gemini_accounts (call_count);
 create index if not exists idx_gemini_accounts_enabled on gemini_accounts (enabled);
+
+-- 原子化轮询：一次 RPC 完成“选最少使用账号 + 计数 +1 + 盖时间戳”，
+-- 代替客户端的 GET + PATCH 两次往返。
+-- FOR UPDATE SKIP LOCKED 保证并发 worker 不会选中同一行。
+create or replace function next_gemini_account()
+returns setof gemini_accounts
+language sql
+as $$
+  with picked as (
+    select alias
+    from gemini_accounts
+    where enabled = true
+    order by call_count asc
+    limit 1
+    for update skip locked
+  )
+  update gemini_accounts g
+  set call_count = g.call_count + 1,
+      last_used = now()
+  from picked
+  where g.alias = picked.alias
+  returning g.*;
+$$;
+
+-- 批量合并计数：客户端把内存里累积的多次 +1 合并成一次 RPC 写入。
+-- payload 形如 {"alias1": 3, "alias2": 1}
+create or replace function bump_call_counts(payload jsonb)
+returns void
+language sql
+as $$
+  update gemini_accounts g
+  set call_count = g.call_count + (payload->>g.alias)::bigint,
+      last_used = now()
+  where payload ? g.alias;
+$$;
+
+-- 全表清零计数：returns void，PostgREST 不会把所有行序列化回客户端
+-- （PATCH + Prefer: return=representation 会把整表行数据传回来）
+create or replace function reset_gemini_counts()
+returns void
+language sql
+as $$
+  update gemini_accounts set call_count = 0;
+$$;
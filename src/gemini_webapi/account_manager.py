@@ -1,7 +1,32 @@
 import os
+import time
+import atexit
+import random
+import functools
+import threading
+from collections import defaultdict
+
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
+from cachetools.keys import hashkey
 from typing import Optional, Dict, Any
-from datetime import datetime
+
+# 进程级共享的异步客户端：HTTP/2 + 连接池，惰性创建
+_async_client: Optional[httpx.AsyncClient] = None
+
+def _get_async_client() -> httpx.AsyncClient:
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(5.0, connect=2.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _async_client
 
 class GeminiAccountManager:
     """
@@ -28,83 +53,320 @@ class GeminiAccountManager:
             "Prefer": "return=representation"  # 让 Supabase 返回数据
         }
 
+        # 热路径常量提前算好：endpoint URL 与选号查询参数
+        # （requests 接受键值对序列，跳过每次的 f-string 和 dict 分配）
+        self._accounts_endpoint = f"{self.api_url}/gemini_accounts"
+        self._bump_endpoint = f"{self.api_url}/rpc/bump_call_counts"
+        self._next_params = (
+            ("select", self._NEXT_COLUMNS),
+            ("enabled", "eq.true"),
+            ("order", "call_count.asc"),
+            ("limit", "5"),
+        )
+
+        # 持久化 Session：keep-alive 复用 TCP+TLS 连接，
+        # 避免每次调用都重新握手（每次可省 1-2 个 RTT）
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # 账号信息 TTL 缓存：psid/psidts/proxy 等字段很少变化，
+        # 60 秒内的重复查询直接走内存，省掉整个 HTTP 往返
+        self._account_cache = TTLCache(maxsize=64, ttl=60)
+
+        # ETag 复验：TTL 过期后带 If-None-Match 重新请求，
+        # 数据未变时 PostgREST 返回 304 空响应体，省掉传输和 JSON 解析
+        self._etags: Dict[str, tuple] = {}  # alias -> (etag, row)
+
+        # call_count 增量先记入内存，5 秒去抖动后合并成一次
+        # bump_call_counts RPC 写入（见 setup_supabase.sql），
+        # 把纯统计写操作移出热路径
+        self._pending: Dict[str, int] = defaultdict(int)
+        self._flush_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self._flush)  # 进程退出时不丢计数
+
+        # stale-while-revalidate：2 秒内的选号直接复用上次结果，
+        # 由后台线程刷新，绝大多数调用不等待 Supabase
+        self._cached_next: Optional[tuple] = None  # (account, monotonic_ts)
+        self._refreshing = False
+
+        # 熔断器：连续失败 5 次后 30 秒内不再访问 Supabase，
+        # 期间直接返回最后一次成功的选号，优雅降级而非一直挂起
+        self._consecutive_failures = 0
+        self._circuit_open_until = 0.0
+
+    def _record_call(self, alias: str):
+        """把一次调用记入内存缓冲，并保证有一个待触发的冲刷定时器"""
+        with self._flush_lock:
+            self._pending[alias] += 1
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(5.0, self._flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush(self):
+        """把累积的增量合并成一次 bump_call_counts RPC 写入"""
+        with self._flush_lock:
+            pending, self._pending = dict(self._pending), defaultdict(int)
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        if not pending:
+            return
+
+        try:
+            resp = self.session.post(
+                self._bump_endpoint,
+                data=orjson.dumps({"payload": pending}),
+                timeout=self._TIMEOUT
+            )
+            if resp.status_code not in [200, 204]:
+                print(f"Warning: Failed to flush call counts: {resp.text}")
+        except Exception as e:
+            print(f"Warning: Failed to flush call counts: {e}")
+
+    # 只取会用到的列：省掉 enabled/last_used/last_updated 等字段的
+    # 传输和 JSON 解析（headers jsonb 仍需返回给客户端构造用）
+    _NEXT_COLUMNS = "alias,psid,psidts,proxy,headers,call_count"
+    # 选号缓存的新鲜窗口（秒）
+    _NEXT_TTL = 2.0
+    # 超时（连接，读取）——避免挂死的 socket 无限阻塞调用方
+    _TIMEOUT = (2.0, 5.0)
+    # 熔断阈值与冷却时间
+    _BREAKER_THRESHOLD = 5
+    _BREAKER_COOLDOWN = 30.0
+
+    def _note_success(self):
+        self._consecutive_failures = 0
+
+    def _note_failure(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self._BREAKER_THRESHOLD:
+            self._circuit_open_until = time.monotonic() + self._BREAKER_COOLDOWN
+            self._consecutive_failures = 0
+            print(f"Warning: Supabase circuit opened for {self._BREAKER_COOLDOWN:.0f}s")
+
+    @staticmethod
+    def _pick_account(candidates: list) -> Dict[str, Any]:
+        """按 1/(call_count+1) 加权随机选号
+
+        避免所有 worker 同时抢“全局最便宜”的同一行，
+        把后续计数写入的热点摊到 K 个独立的行上。
+        """
+        if len(candidates) == 1:
+            return candidates[0]
+        weights = [1.0 / ((a.get("call_count") or 0) + 1) for a in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+    def _select_candidates(self) -> list:
+        """只读查询最少使用的 K 个账号，并更新选号缓存"""
+        # GET /gemini_accounts?enabled=eq.true&order=call_count.asc&limit=5
+        resp = self.session.get(
+            self._accounts_endpoint,
+            params=self._next_params,
+            timeout=self._TIMEOUT
+        )
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to fetch accounts: {resp.text}")
+
+        accounts = orjson.loads(resp.content)
+        if not accounts:
+            raise Exception("没有可用的 Gemini 账号 (No enabled accounts found)")
+
+        self._cached_next = (accounts, time.monotonic())
+        return accounts
+
+    def _refresh_next(self):
+        """后台刷新选号缓存（stale-while-revalidate 的 revalidate 半边）"""
+        try:
+            self._select_candidates()
+        except Exception as e:
+            print(f"Warning: Failed to refresh next account: {e}")
+        finally:
+            self._refreshing = False
+
+    def _cached_candidates(self) -> Optional[list]:
+        """命中新鲜窗口（或熔断打开期间）时返回缓存的候选列表，否则 None
+
+        命中时顺手触发一次后台刷新（熔断打开期间除外），
+        同步/异步取号路径共用这套 SWR + 熔断判定。
+        """
+        cached = self._cached_next
+        now = time.monotonic()
+        if cached and (now - cached[1] < self._NEXT_TTL or now < self._circuit_open_until):
+            if not self._refreshing and now >= self._circuit_open_until:
+                self._refreshing = True
+                threading.Thread(target=self._refresh_next, daemon=True).start()
+            return cached[0]
+        return None
+
+    def _fallback_candidates(self, error: Exception) -> list:
+        """选号查询失败：记一次失败并降级到最后一次成功的候选"""
+        self._note_failure()
+        cached = self._cached_next
+        if not cached:
+            raise error
+        print(f"Warning: Supabase unavailable, using cached account: {error}")
+        return cached[0]
+
+    def _finish_pick(self, candidates: list) -> Dict[str, Any]:
+        """从候选里加权选号、记一次调用并整形返回"""
+        account = self._pick_account(candidates)
+        self._record_call(account["alias"])
+        return self._shape_account(account)
+
     def get_next_account(self) -> Dict[str, Any]:
         """
         轮询获取下一个可用账号
+
+        stale-while-revalidate：新鲜窗口内直接复用上次选号并触发
+        后台刷新，p50 延迟降到内存读；call_count 的 +1 记入内存缓冲，
+        由去抖动定时器按批冲刷，用户请求不再等待统计写入。
+        Supabase 不可用时熔断降级为最后一次成功的选号。
         """
-        # 1. 查询可用账号，按 call_count 排序
-        # GET /gemini_accounts?enabled=eq.true&order=call_count.asc&limit=1
         try:
-            resp = requests.get(
-                f"{self.api_url}/gemini_accounts",
-                headers=self.headers,
-                params={
-                    "enabled": "eq.true",
-                    "order": "call_count.asc",
-                    "limit": "1"
-                }
-            )
-            
-            if resp.status_code != 200:
-                raise Exception(f"Failed to fetch accounts: {resp.text}")
-                
-            accounts = resp.json()
-            if not accounts:
-                raise Exception("没有可用的 Gemini 账号 (No enabled accounts found)")
-                
-            account = accounts[0]
-            
-            # 2. 更新计数
-            # PATCH /gemini_accounts?alias=eq.{alias}
-            new_count = (account.get("call_count") or 0) + 1
-            
-            update_resp = requests.patch(
-                f"{self.api_url}/gemini_accounts",
-                headers=self.headers,
-                params={"alias": f"eq.{account['alias']}"},
-                json={
-                    "call_count": new_count,
-                    "last_used": datetime.now().isoformat()
-                }
-            )
-            
-            if update_resp.status_code not in [200, 204]:
-                print(f"Warning: Failed to update usage count: {update_resp.text}")
-            
-            # 3. 返回数据
-            return {
-                "alias": account["alias"],
-                "psid": account["psid"],
-                "psidts": account["psidts"],
-                "proxy": account.get("proxy"),
-                "headers": account.get("headers"),
-                "call_count": new_count
-            }
-            
+            candidates = self._cached_candidates()
+            if candidates is None:
+                try:
+                    candidates = self._select_candidates()
+                    self._note_success()
+                except Exception as e:
+                    candidates = self._fallback_candidates(e)
+
+            return self._finish_pick(candidates)
+
         except Exception as e:
             print(f"Error in GeminiAccountManager: {e}")
             raise e
 
+    async def aget_next_account(self) -> Dict[str, Any]:
+        """
+        get_next_account 的异步版本
+
+        在 async 上下文（如 FastAPI 路由）中使用，
+        账号查询不再阻塞事件循环一个 RTT。选号缓存、计数缓冲、
+        SWR 与熔断逻辑全部与同步版本共享。
+        """
+        try:
+            candidates = self._cached_candidates()
+            if candidates is None:
+                try:
+                    client = _get_async_client()
+                    resp = await client.get(
+                        self._accounts_endpoint,
+                        headers=self.headers,
+                        params=dict(self._next_params)
+                    )
+
+                    if resp.status_code != 200:
+                        raise Exception(f"Failed to fetch accounts: {resp.text}")
+
+                    candidates = orjson.loads(resp.content)
+                    if not candidates:
+                        raise Exception("没有可用的 Gemini 账号 (No enabled accounts found)")
+
+                    self._cached_next = (candidates, time.monotonic())
+                    self._note_success()
+                except Exception as e:
+                    candidates = self._fallback_candidates(e)
+
+            return self._finish_pick(candidates)
+
+        except Exception as e:
+            print(f"Error in GeminiAccountManager: {e}")
+            raise e
+
+    @staticmethod
+    def _shape_account(account: Dict[str, Any]) -> Dict[str, Any]:
+        """统一对外返回的账号字段"""
+        return {
+            "alias": account["alias"],
+            "psid": account["psid"],
+            "psidts": account["psidts"],
+            "proxy": account.get("proxy"),
+            "headers": account.get("headers"),
+            "call_count": account.get("call_count")
+        }
+
     def get_account(self, alias: str) -> Dict[str, Any]:
-        """获取指定账号"""
-        resp = requests.get(
-            f"{self.api_url}/gemini_accounts",
-            headers=self.headers,
-            params={"alias": f"eq.{alias}"}
+        """获取指定账号（带 60 秒 TTL 内存缓存 + ETag 复验）"""
+        key = hashkey(alias)
+        if key in self._account_cache:
+            return self._account_cache[key]
+
+        headers = {"Prefer": "count=none"}
+        cached = self._etags.get(alias)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+
+        resp = self.session.get(
+            self._accounts_endpoint,
+            params={"select": self._NEXT_COLUMNS, "alias": f"eq.{alias}"},
+            headers=headers,
+            timeout=self._TIMEOUT
         )
-        data = resp.json()
+
+        if resp.status_code == 304 and cached:
+            # 数据未变：复用上次的行，只刷新 TTL
+            self._account_cache[key] = cached[1]
+            return cached[1]
+
+        data = orjson.loads(resp.content)
         if not data:
             raise Exception(f"Account '{alias}' not found")
+
+        etag = resp.headers.get("ETag")
+        if etag:
+            self._etags[alias] = (etag, data[0])
+
+        self._account_cache[key] = data[0]
         return data[0]
 
+    def invalidate(self, alias: Optional[str] = None):
+        """失效缓存：指定 alias，或不传参数清空全部（写路径后调用）"""
+        if alias is None:
+            self._account_cache.clear()
+        else:
+            self._account_cache.pop(hashkey(alias), None)
+
     def reset_counts(self):
-        """重置所有账号计数"""
-        requests.patch(
-            f"{self.api_url}/gemini_accounts",
-            headers=self.headers,
-            # Supabase 需要至少一个过滤条件防止误删？但 update all 也是可能的
-            # 如果不带条件，Supabase 可能会拒绝（取决于安全设置）。
-            # 我们可以使用 alias not equals 'dummy' 作为全表条件
-            params={"alias": "neq.PLACEHOLDER"},
-            json={"call_count": 0}
+        """重置所有账号计数
+
+        走 reset_gemini_counts() RPC（returns void）：全表 PATCH 配合
+        Prefer: return=representation 会把所有行序列化传回来，
+        对一个不关心返回值的调用方纯属浪费。
+        """
+        resp = self.session.post(
+            f"{self.api_url}/rpc/reset_gemini_counts",
+            data=b"{}",
+            timeout=self._TIMEOUT
         )
+        if resp.status_code not in [200, 204]:
+            print(f"Warning: Failed to reset counts: {resp.text}")
+        # 计数变了：账号缓存与选号缓存一并失效
+        self.invalidate()
+        self._cached_next = None
+
+
+@functools.lru_cache(maxsize=1)
+def get_manager(
+    supabase_url: Optional[str] = None, supabase_key: Optional[str] = None
+) -> GeminiAccountManager:
+    """
+    进程级单例：同一组配置只构建一个管理器，
+    连接池、各级缓存与计数缓冲全进程共享。
+    """
+    return GeminiAccountManager(supabase_url, supabase_key)